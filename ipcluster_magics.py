@@ -1,14 +1,48 @@
 # System
+import argparse
+import atexit
+import functools
+import shlex
 import subprocess
+import sys
 import os
-import threading
 
 # 3rd-party
-from IPython import get_ipython 
 from IPython.core.magic import line_magic, magics_class, Magics
-from docopt import docopt, DocoptExit
 import tempfile
 
+def _remove_scripts(scripts):
+    for script in scripts:
+        try:
+            os.unlink(script)
+        except FileNotFoundError:
+            pass
+        _pending_files.discard(script)
+
+def _cleanup():
+    # salloc outlives the kernel, so scripts of jobs still queued or
+    # running must stay for bash and ssh to read
+    live = set()
+    for proc, scripts in _jobs.values():
+        if proc.poll() is None:
+            live.update(scripts)
+    _remove_scripts([script for script in _pending_files if script not in live])
+
+# Scripts not yet removed, shared by all instances. The guard keeps the set
+# and its single exit handler across %reload_ext.
+try:
+    _pending_files
+except NameError:
+    _pending_files = set()
+    atexit.register(_cleanup)
+
+# Background jobs and their scripts, keyed by pid. Kept across %reload_ext
+# like the set above, so jobs started before a reload are still reaped.
+try:
+    _jobs
+except NameError:
+    _jobs = {}
+
 @magics_class
 class IPClusterMagics(Magics):
     """engine an IPyParallel cluster.
@@ -18,30 +52,17 @@ Usage:
   %ipcluster [options] -m <modules>...
   %ipcluster (-h | --help)
   %ipcluster --version
-  
-Options:
-  -h --help                Show this screen.
-  -v --version             Show version.
-  -N --num_nodes <int>     Number of nodes (default 1).
-  -n --num_engines <int>   Number of engines (default 1 per node).
-  -m --modules <str>       Modules to load (default none).
-  -e --env <str>           Conda env to load (default none).
-  -t --time <time>         Time limit (default 30:00).
-  -d --dir <path>          Directory to engine engines (default $HOME)
-  -C --const <str>         SLURM contraint (default haswell).
-  -q --queue <str>         SLURM queue (default interactive).
-  -J --name <str>          Job name (default ipyparallel)
+
+Run %ipcluster -h for the list of options.
 """
 
-    def __init__(self, shell):
-        super().__init__(shell)
-        self.define_strings()
-    
-    def define_strings(self):
-        self.__version__ = "%ipcluster 0.1"
-        
-        # If we want to use sbatch
-        self.header_template = """
+    __version__ = "%ipcluster 0.1"
+
+    # Print generated scripts before submission
+    debug = False
+
+    # If we want to use sbatch
+    header_template = """
 #!/bin/bash -l
 #SBATCH -J {name}
 #SBATCH -q {queue}
@@ -50,35 +71,32 @@ Options:
 #SBATCH -C {constraint}
 #SBATCH -L SCRATCH
 """
-        
-        # If we want to use salloc
-        self.salloc_template = 'salloc -J {name} -q {queue} -N {num_nodes} -t {time} -C {const} bash {script}'
 
-        self.module_template = """
+    module_template = """
 # Load modules
-mod="{module}"
+mod={module}
 module load "$mod"
 #echo "Loaded module $mod"
 export PATH=$PYTHONUSERBASE/bin:$PATH
 """
-        self.env_template = """
+    env_template = """
 # Load conda env
-env="{env}"
+env={env}
 source activate "$env"
 #echo "Loaded env $env"
 """
-        self.engine_template = """
-ipengine --log-to-file
-#echo "Started engine."
-"""
+    # Engines inherit the modules and env loaded by the batch script
+    engine_template = 'ipengine --timeout=60 --log-level=WARN --log-to-file'
 
-        self.controller_template = """       
-myip=$(ip addr show ipogif0 | grep '10\.' | awk '{{print $2}}' | awk -F'/' '{{print $1}}')
+    controller_template = """       
+# Parse the ipogif0 IPv4 address with bash builtins instead of a pipeline
+read -r _ _ _ myip _ < <(ip -4 -o addr show dev ipogif0)
+myip=${{myip%%/*}}
 ipcontroller --ip="$myip" --log-to-file
 #echo "Started controller on '$myip'."
 """
-        
-        self.cluster_template = """
+
+    cluster_template = """
 # Get head node hostname (from mom node)
 headnode=$(scontrol show job "$SLURM_JOBID" | grep BatchHost | awk -F= '{{print $2}}')
 
@@ -90,123 +108,154 @@ ssh -o LogLevel=error $headnode 'bash {controller_script}' > /dev/null &
 sleep 30
 
 # Start engines
-srun -N {num_engines} -n {num_engines} -c 1 -s bash {engine_script}
+srun -N {num_engines} -n {num_engines} -c 1 -s {engine_command}
 #echo "Started engines."
 """
 
+    def __init__(self, shell):
+        super().__init__(shell)
+        
+        # Temporary scripts live on SCRATCH so compute nodes can read them
+        scratch = os.environ['SCRATCH']
+        self._controller_prefix = os.path.join(scratch, '.ipccontroller')
+        self._batch_prefix = os.path.join(scratch, '.ipcbatch')
+        
+        # Parse options with a parser built once
+        self._parser = self.build_parser()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def format_module(module):
+        # The same modules are loaded into every script
+        return IPClusterMagics.module_template.format(module=shlex.quote(module))
+
+    def build_parser(self):
+        parser = argparse.ArgumentParser(prog='%ipcluster',
+                                         description='Start an IPyParallel cluster.')
+        parser.add_argument('-v', '--version', action='version', version=self.__version__,
+                            help='Show version.')
+        parser.add_argument('-N', '--num_nodes', type=int, default=1, metavar='<int>',
+                            help='Number of nodes (default 1).')
+        parser.add_argument('-n', '--num_engines', type=int, metavar='<int>',
+                            help='Number of engines (default 1 per node).')
+        parser.add_argument('-m', '--modules', nargs='+', metavar='<str>',
+                            help='Modules to load (default none).')
+        parser.add_argument('-e', '--env', metavar='<str>',
+                            help='Conda env to load (default none).')
+        parser.add_argument('-t', '--time', default='30:00', metavar='<time>',
+                            help='Time limit (default 30:00).')
+        parser.add_argument('-d', '--dir', metavar='<path>',
+                            help='Directory to start engines in (default $HOME).')
+        parser.add_argument('-C', '--const', default='haswell', metavar='<str>',
+                            help='SLURM constraint (default haswell).')
+        parser.add_argument('-q', '--queue', default='interactive', metavar='<str>',
+                            help='SLURM queue (default interactive).')
+        parser.add_argument('-J', '--name', default='ipyparallel', metavar='<str>',
+                            help='Job name (default ipyparallel).')
+        return parser
+
     def parse_args(self, line):
-        # Valid syntax
         try:
-            args = docopt(self.__doc__, argv=line.split(), version=self.__version__)
-        # Invalid syntax
-        except DocoptExit:
-            print("Invalid syntax.")
-            print(self.__doc__)
-            return 
-        # Other normal exit (--version)
+            parsed_args = vars(self._parser.parse_args(line.split()))
+        # Invalid syntax, --help or --version
         except SystemExit:
-            args = {}
-            
-        defaults = {
-            '--name': 'ipyparallel',
-            '--num_nodes': 1,
-            '--modules': None,
-            '--env': None,
-            '--queue': 'interactive',
-            '--time': '30:00',
-            '--const': 'haswell'
-        }
-        
-        given = {key: val for key, val in args.items() if val}
-        combined = {**defaults, **given}
-        
-        # Remove '--' from args
-        parsed_args = {key[2:]: val for key, val in combined.items()}
+            return
         
         # Set number of engines
-        if 'num_engines' not in parsed_args.keys():
+        if parsed_args['num_engines'] is None:
             parsed_args['num_engines'] = parsed_args['num_nodes']
         
         return parsed_args
     
-    def load_modules(self, fh, modules):
+    def load_modules(self, modules):
         if modules:
-            for module in modules:
-                mod_str = self.module_template.format(module=module) 
-                fh.write(mod_str)
+            return ''.join(self.format_module(module) for module in modules)
+        return ''
     
-    def activate_env(self, fh, env):
+    def activate_env(self, env):
         if env:
-            env_str = self.env_template.format(env=env)
-            fh.write(env_str)
-        
-    def start_controller(self, fh):
-        fh.write(self.controller_template)
+            return self.env_template.format(env=shlex.quote(env))
+        return ''
         
-    def start_engine(self, fh):
-        fh.write(self.engine_template)
+    def start_controller(self):
+        return self.controller_template.format()
         
-    def start_cluster(self, fh, num_engines, controller_script, engine_script):
-        cluster_str = self.cluster_template.format(
+    def start_cluster(self, num_engines, controller_script):
+        return self.cluster_template.format(
             num_engines=num_engines,
             controller_script=controller_script,
-            engine_script=engine_script
+            engine_command=self.engine_template
         )
-        fh.write(cluster_str)
     
-    def create_controller_script(self, fh, modules, env):
-        self.load_modules(fh, modules)
-        self.activate_env(fh, env)
-        self.start_controller(fh)
-        
-        self.read_script(fh)
-        
-    def create_engine_script(self, fh, modules, env):
-        self.load_modules(fh, modules)
-        self.activate_env(fh, env)
-        self.start_engine(fh)
+    def write_script(self, fh, parts):
+        # Issue a single write per script
+        fh.write(''.join(parts))
+        fh.flush()
         
         self.read_script(fh)
+    
+    def create_controller_script(self, fh, modules, env):
+        self.write_script(fh, [
+            self.load_modules(modules),
+            self.activate_env(env),
+            self.start_controller()
+        ])
         
-    def create_batch_script(self, fh, modules, env, num_engines, controller_script, engine_script):
-        self.load_modules(fh, modules)
-        self.activate_env(fh, env)
-        self.start_cluster(fh, num_engines, controller_script, engine_script)
-        
-        self.read_script(fh)
+    def create_batch_script(self, fh, modules, env, num_engines, controller_script):
+        self.write_script(fh, [
+            self.load_modules(modules),
+            self.activate_env(env),
+            self.start_cluster(num_engines, controller_script)
+        ])
         
     def read_script(self, fh):
+        if not self.debug:
+            return
+        # Read back through our own handle rather than forking cat
         fh.seek(0)
-        # print("Script:")
-        # print(subprocess.check_output(['cat', fh.name]).decode())
-        # print("EOF")
+        sys.stdout.write("Script:\n" + fh.read() + "\nEOF\n")
     
     def get_salloc_line(self, batch_script, args):
-        return self.salloc_template.format(script=batch_script, **args)
+        # Argument list, so user values never pass through a shell
+        return [
+            'salloc',
+            '-J', args['name'],
+            '-q', args['queue'],
+            '-N', str(args['num_nodes']),
+            '-t', args['time'],
+            '-C', args['const'],
+            'bash', batch_script
+        ]
     
-    def system_thread(self, command, fhs):
-        def execute(cmd, fhs):
-            # Run command
-            get_ipython().system(cmd)
+    def system_background(self, command, scripts):
+        # Run command without blocking the notebook; it inherits our stdout/stderr.
+        # A session of its own keeps kernel interrupts (SIGINT to our process
+        # group) away from salloc, and no stdin keeps srun off the terminal.
+        proc = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                                start_new_session=True)
+        
+        # Keep temporary scripts on disk until the command exits
+        _jobs[proc.pid] = (proc, scripts)
+    
+    def reap_jobs(self):
+        for pid, (proc, scripts) in list(_jobs.items()):
+            if proc.poll() is None:
+                continue
             
-            # Close temporary files
-            for fh in fhs:
-                fh.close()
-                
-        thread = threading.Thread(target=execute, args=(command, fhs))
-        thread.start()
+            _remove_scripts(scripts)
+            del _jobs[pid]
     
     def submit_job(self, args):
-        controller_prefix = os.path.join(os.environ['SCRATCH'], '.ipccontroller')
-        engine_prefix = os.path.join(os.environ['SCRATCH'], '.ipcengine')
-        batch_prefix = os.path.join(os.environ['SCRATCH'], '.ipcbatch')
+        # Clean up after previous submissions that have finished
+        self.reap_jobs()
         
         # Create temporary files
-        # They'll be destroyed after submission
-        engine_fh = tempfile.NamedTemporaryFile('w', prefix=engine_prefix)
-        controller_fh = tempfile.NamedTemporaryFile('w', prefix=controller_prefix)
-        batch_fh = tempfile.NamedTemporaryFile('w', prefix=batch_prefix)
-        fhs = [controller_fh, engine_fh, batch_fh]
+        # They're removed once salloc exits, or when IPython exits
+        controller_fh = tempfile.NamedTemporaryFile('w+', prefix=self._controller_prefix, delete=False)
+        batch_fh = tempfile.NamedTemporaryFile('w+', prefix=self._batch_prefix, delete=False)
+        fhs = [controller_fh, batch_fh]
+        scripts = [fh.name for fh in fhs]
+        _pending_files.update(scripts)
         
         # Create controller script
         controller_script = controller_fh.name
@@ -216,14 +265,6 @@ srun -N {num_engines} -n {num_engines} -c 1 -s bash {engine_script}
             args['env']
         )
 
-        # Create engine script
-        engine_script = engine_fh.name
-        self.create_engine_script(
-            engine_fh,
-            args['modules'],
-            args['env']
-        )
-
         # Create batch script
         batch_script = batch_fh.name
         self.create_batch_script(
@@ -231,14 +272,17 @@ srun -N {num_engines} -n {num_engines} -c 1 -s bash {engine_script}
             args['modules'], 
             args['env'],
             args['num_engines'],
-            controller_script,
-            engine_script
+            controller_script
         )
 
+        # Compute nodes only need the paths
+        for fh in fhs:
+            fh.close()
+
         # Run salloc
         salloc_line = self.get_salloc_line(batch_script, args)
         # print(salloc_line)
-        self.system_thread(salloc_line, fhs)
+        self.system_background(salloc_line, scripts)
 
     @line_magic
     def ipcluster(self, line):
@@ -250,7 +294,22 @@ srun -N {num_engines} -n {num_engines} -c 1 -s bash {engine_script}
             return
 
         self.submit_job(args)
-    
-ip = get_ipython()
-ipcluster_magics = IPClusterMagics(ip)
-ip.register_magics(ipcluster_magics)
+
+
+# Instance registered by load_ipython_extension
+_magics = None
+
+def load_ipython_extension(ipython):
+    """Register the magics on %load_ext ipcluster_magics"""
+    global _magics
+    _magics = IPClusterMagics(ipython)
+    ipython.register_magics(_magics)
+    # Reap finished salloc jobs after every cell, not just the next submission
+    ipython.events.register('post_execute', _magics.reap_jobs)
+
+def unload_ipython_extension(ipython):
+    """Drop the reaping hook on %unload_ext / %reload_ext"""
+    global _magics
+    if _magics is not None:
+        ipython.events.unregister('post_execute', _magics.reap_jobs)
+        _magics = None
@@ -1,16 +1,83 @@
 import os
+import queue
+import threading
 
 import keras
 import tensorflow as tf
 from mnist import build_model
 from ipyparallel.datapub import publish_data
 
+# Queued to stop the publisher thread
+_STOP = object()
+
 class IPyParallelLogger(keras.callbacks.Callback):
-    def __init__(self):
+    def __init__(self, max_pending=64, idle_timeout=60):
         super(IPyParallelLogger, self).__init__()
         self.history = {}
+        # Epochs per publish; the history carries every buffered epoch
+        self._flush_every = int(os.environ.get('IPP_LOG_FLUSH', 1))
+        self._buf = []
+        # Publish from a background thread so training never waits on the controller
+        self._q = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._publisher = None
+        self._idle_timeout = idle_timeout
+        self._error = None
+
+    def _publish_loop(self):
+        while True:
+            try:
+                data = self._q.get(timeout=self._idle_timeout)
+            except queue.Empty:
+                # Exit when idle, e.g. if fit raised and on_train_end never ran;
+                # publish starts a new thread if more data arrives
+                with self._lock:
+                    if self._q.empty():
+                        self._publisher = None
+                        return
+                continue
+            if data is _STOP:
+                return
+            try:
+                publish_data(data)
+            except Exception as e:
+                # Keep draining; the first error is re-raised by on_train_end
+                if self._error is None:
+                    self._error = e
+
+    def publish(self, status, **kwargs):
+        """Queue a snapshot of the history, dropping the oldest update if full"""
+        data = {"status": status,
+                "history": {k: list(v) for k, v in self.history.items()}}
+        data.update(kwargs)
+        with self._lock:
+            while True:
+                try:
+                    self._q.put_nowait(data)
+                    break
+                except queue.Full:
+                    try:
+                        self._q.get_nowait()
+                    except queue.Empty:
+                        pass
+            if self._publisher is None:
+                self._publisher = threading.Thread(target=self._publish_loop, daemon=True)
+                self._publisher.start()
+
+    def _stop_publisher(self):
+        """Let the publisher drain the queue, then stop it"""
+        with self._lock:
+            publisher, self._publisher = self._publisher, None
+            if publisher is None:
+                return
+            self._q.put(_STOP)
+        publisher.join()
 
     def on_train_begin(self, logs):
+        # Stop a publisher left running by a run that raised before on_train_end
+        self._stop_publisher()
+        self._buf = []
+        self._error = None
         self.history = {
             "acc": [],
             "loss": [],
@@ -18,26 +85,59 @@ class IPyParallelLogger(keras.callbacks.Callback):
             "val_loss": [],
             "epoch": []
         }
-        publish_data({"status": "Begin Training", "history": self.history})
+        self.publish("Begin Training")
+
+    def flush(self):
+        """Publish the epochs ended since the last update in one update"""
+        if self._buf:
+            self.publish("Ended Epoch", epoch=self._buf[-1])
+            self._buf = []
 
     def on_train_end(self, logs):
-        publish_data({"status": "Ended Training", "history": self.history})
+        self.flush()
+        self.publish("Ended Training")
+        # Stop the publisher once the final status has gone out
+        self._stop_publisher()
+        if self._error is not None:
+            raise self._error
 
     def on_epoch_begin(self, epoch, logs):
-        publish_data({"status": "Begin Epoch", "epoch": epoch, "history": self.history})
+        # Only announce the first epoch of each buffered batch
+        if not self._buf:
+            self.publish("Begin Epoch", epoch=epoch)
 
     def on_epoch_end(self, epoch, logs):
+        # Plain floats pickle cheaper than numpy scalars
+        logs = {k: float(v) for k, v in logs.items()}
         for k in logs:
             self.history[k].append(logs[k])
         self.history["epoch"].append(epoch)
-        publish_data({"status": "Ended Epoch", "epoch": epoch, "history": self.history})
+        self._buf.append(epoch)
+        if len(self._buf) >= self._flush_every:
+            self.flush()
 
 def configure_session():
     """Make a TF session configuration with appropriate thread settings"""
     n_inter_threads = int(os.environ.get('NUM_INTER_THREADS', 2))
     n_intra_threads = int(os.environ.get('NUM_INTRA_THREADS', 32))
+    # MKL/OpenMP settings; these only take effect before the first session
+    os.environ.setdefault('KMP_BLOCKTIME', '0')
+    os.environ.setdefault('KMP_AFFINITY', 'granularity=fine,compact,1,0')
+    os.environ.setdefault('OMP_NUM_THREADS', str(n_intra_threads))
     config = tf.ConfigProto(
         inter_op_parallelism_threads=n_inter_threads,
         intra_op_parallelism_threads=n_intra_threads
     )
+    if tf.test.is_built_with_cuda():
+        config.gpu_options.allow_growth = True
     return tf.Session(config=config)
+
+# Session shared by every task run in this process
+_session = None
+
+def get_session():
+    """Configure one TF session per process and reuse it across tasks"""
+    global _session
+    if _session is None:
+        _session = configure_session()
+    return _session
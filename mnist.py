@@ -6,6 +6,7 @@ This module contains model and training code for the MNIST classifier.
 from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
+import functools
 
 # Data libraries
 import numpy as np
@@ -57,3 +58,58 @@ def build_model(h1=4, h2=8, h3=32, dropout=0.5,
     model.compile(optimizer=optimizer, loss=categorical_crossentropy,
                   metrics=['accuracy'])
     return model
+
+class BatchSequence(keras.utils.Sequence):
+    """Shuffled mini-batches over in-memory arrays"""
+    def __init__(self, x, y, batch_size):
+        self.x, self.y = x, y
+        self.batch_size = batch_size
+        self.index = np.random.permutation(len(x))
+
+    def __len__(self):
+        return int(np.ceil(len(self.x) / self.batch_size))
+
+    def __getitem__(self, i):
+        idx = self.index[i * self.batch_size:(i + 1) * self.batch_size]
+        return self.x[idx], self.y[idx]
+
+    def on_epoch_end(self):
+        np.random.shuffle(self.index)
+
+def train_model(model, x_train, y_train, valid_frac, batch_size, n_epochs,
+                verbose=0, callbacks=None, max_queue_size=10):
+    """Train the model, assembling batches in a background thread"""
+    # Hold out the last samples for validation, like validation_split
+    split_at = int(len(x_train) * (1. - valid_frac))
+    x_valid, y_valid = x_train[split_at:], y_train[split_at:]
+    x_train, y_train = x_train[:split_at], y_train[:split_at]
+    train_seq = BatchSequence(x_train, y_train, batch_size)
+    return model.fit_generator(train_seq, epochs=n_epochs,
+                               validation_data=(x_valid, y_valid),
+                               callbacks=callbacks, verbose=verbose,
+                               max_queue_size=max_queue_size, workers=1)
+
+# Session the cached models below belong to
+_cache_session = None
+
+@functools.lru_cache(maxsize=8)
+def _build_cached_model(h1, h2, h3, dropout, optimizer):
+    model = build_model(h1=h1, h2=h2, h3=h3, dropout=dropout,
+                        optimizer=optimizer)
+    return model, model.get_weights()
+
+def get_model(h1=4, h2=8, h3=32, dropout=0.5, optimizer='Adadelta'):
+    """Fetch a freshly initialized model, reusing the graph of an earlier
+    model with the same topology in the current session"""
+    global _cache_session
+    # Models from another session have no initialized variables here
+    if K.get_session() is not _cache_session:
+        _build_cached_model.cache_clear()
+        _cache_session = K.get_session()
+    model, initial_weights = _build_cached_model(h1, h2, h3, dropout,
+                                                 optimizer)
+    # Reset the layer and optimizer state from the previous trial
+    model.set_weights(initial_weights)
+    K.batch_set_value([(w, np.zeros(K.int_shape(w)))
+                       for w in model.optimizer.weights])
+    return model
@@ -76,8 +76,10 @@ def train_model(model, train_input, train_labels,
                 batch_size, n_epochs,
                 lr_warmup_epochs=0, lr_reduce_patience=8,
                 checkpoint_file=None, use_horovod=False,
-                verbose=2, callbacks=[]):
+                verbose=2, callbacks=None):
     """Train the model"""
+    # Copy so neither the caller's list nor a shared default grows per call
+    callbacks = [] if callbacks is None else list(callbacks)
     if use_horovod:
         import horovod.keras as hvd
         callbacks += [